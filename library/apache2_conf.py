@@ -24,7 +24,11 @@
 Apache 2.'''
 
 from __future__ import absolute_import, division, print_function
+import json
+import os
 import re
+import time
+from collections import namedtuple
 
 # pylint: disable=invalid-name
 __metaclass__ = type
@@ -64,6 +68,38 @@ options:
         - 'exclusive_present' enables only the listed items and disables all other items.
      choices: ['present', 'exclusive_present', 'absent']
      default: present
+   assume_state:
+     description:
+        - In check mode, assume that all items are already in the desired state
+          instead of querying them with C(a2query).
+        - The task then never reports a change and does not return the lists
+          of enabled items.
+        - Has no effect outside of check mode.
+     type: bool
+     default: 'no'
+   cache:
+     description:
+        - Cache the lists of enabled items in C(/run/apache2_conf.cache.json) on
+          the managed host, so that later tasks do not need to run C(a2query).
+        - A cached list is only used while the modification time of the
+          corresponding C(*-enabled) directory is unchanged and lies before
+          the second in which the list was cached.
+        - The cached list is dropped whenever this module changes items of
+          that kind.
+     type: bool
+     default: 'yes'
+   skip_check:
+     description:
+        - Do not query the current state with C(a2query), but always run the
+          enable or disable tool and detect changes from its output.
+        - The task then does not return the lists of enabled items.
+        - With I(state=absent), an item which does not exist makes the task
+          fail, as the disable tool reports an error for it. Without
+          I(skip_check), such an item is just reported as unchanged.
+        - Cannot be used with I(state=exclusive_present). Has no effect in
+          check mode.
+     type: bool
+     default: 'no'
 
 requirements: ["a2query", "a2enconf", "a2disconf", "a2enmod", "a2dismod", "a2ensite", "a2dissite"]
 '''
@@ -109,15 +145,15 @@ stderr:
     type: str
 config:
     description: List of all now enabled configurations.
-    returned: always
+    returned: if I(item=config), unless I(assume_state) is set in check mode or I(skip_check) is set
     type: list of str
 module:
     description: List of all now enabled modules.
-    returned: always
+    returned: if I(item=module), unless I(assume_state) is set in check mode or I(skip_check) is set
     type: list of str
 site:
     description: List of all now enabled sites.
-    returned: always
+    returned: if I(item=site), unless I(assume_state) is set in check mode or I(skip_check) is set
     type: list of str
 '''
 
@@ -125,31 +161,39 @@ ITEM_KEY_CONFIG = 'config'
 ITEM_KEY_MODULE = 'module'
 ITEM_KEY_SITE = 'site'
 
+# Information how to handle one kind of items (configs, modules, sites)
+ItemCfg = namedtuple(
+    'ItemCfg',
+    ['name', 'query_flag', 'enable_bin', 'disable_bin', 'enabled_dir', 'name_suffixes'])
+
 # Dictionary with information how to handle items (configs, modules, sites)
 SETTINGS = {
     # Configurations
-    ITEM_KEY_CONFIG: {
-        'name': 'configuration',
-        'query_flag': '-c',
-        'enable_bin': 'a2enconf',
-        'disable_bin': 'a2disconf',
-    },
+    ITEM_KEY_CONFIG: ItemCfg(
+        name='configuration',
+        query_flag='-c',
+        enable_bin='a2enconf',
+        disable_bin='a2disconf',
+        enabled_dir='conf-enabled',
+        name_suffixes=('.conf',)),
 
     # Modules
-    ITEM_KEY_MODULE: {
-        'name': 'module',
-        'query_flag': '-m',
-        'enable_bin': 'a2enmod',
-        'disable_bin': 'a2dismod',
-    },
+    ITEM_KEY_MODULE: ItemCfg(
+        name='module',
+        query_flag='-m',
+        enable_bin='a2enmod',
+        disable_bin='a2dismod',
+        enabled_dir='mods-enabled',
+        name_suffixes=('.load', '.conf')),
 
     # Sites
-    ITEM_KEY_SITE: {
-        'name': 'site',
-        'query_flag': '-s',
-        'enable_bin': 'a2ensite',
-        'disable_bin': 'a2dissite',
-    },
+    ITEM_KEY_SITE: ItemCfg(
+        name='site',
+        query_flag='-s',
+        enable_bin='a2ensite',
+        disable_bin='a2dissite',
+        enabled_dir='sites-enabled',
+        name_suffixes=('.conf',)),
 }
 
 
@@ -162,6 +206,47 @@ RC_A2QUERY_UNKNOWN = 1
 # return code for a2en... / a2dis...
 RC_A2TOOL_OK = 0
 
+# Apache configuration directory, as used by a2query and the a2en... / a2dis...
+# tools.
+APACHE_CONFDIR = os.environ.get('APACHE_CONFDIR', '/etc/apache2')
+
+# File to cache the enabled items across module runs. It is located on a tmpfs
+# and is therefore discarded at boot.
+STATE_CACHE_FILE = '/run/apache2_conf.cache.json'
+
+# Matches an item in the output of a2en... / a2dis... which was not changed,
+# e.g. 'Module alias already enabled'
+_ALREADY_RE = re.compile(
+    r'^(?:Module|Conf|Site) (\S+) already (?:en|dis)abled', re.MULTILINE)
+
+# Cache of resolved command paths, so that $PATH is only searched once per
+# command.
+_BIN_PATH_CACHE = {}
+
+
+def _get_bin_path(module, cmd):
+    '''Return the full path of a command. If the command is not found, fail
+    the module with an error message.
+
+    :param module: Ansible module object.
+    :param str cmd: The command (binary) to look up.
+
+    :returns: str'''
+
+    cmd_bin = _BIN_PATH_CACHE.get(cmd)
+
+    if cmd_bin is None:
+        cmd_bin = module.get_bin_path(cmd)
+
+        # fail if the command cannot be found
+        if cmd_bin is None:
+            error_msg = "Command not found: %s" % cmd
+            module.fail_json(msg=error_msg)
+
+        _BIN_PATH_CACHE[cmd] = cmd_bin
+
+    return cmd_bin
+
 
 def _run_cmd(module, cmd, params):
     '''Run a command. If the command is not found, fail the module with an
@@ -169,72 +254,301 @@ def _run_cmd(module, cmd, params):
 
     :param module: Ansible module object.
     :param str cmd: The command (binary) to execute.
-    :param str params: String with command-line options.
+    :param list params: List of command-line arguments.
 
     :returns: Tuple of (exit code, standard output, standard error output)'''
 
-    cmd_bin = module.get_bin_path(cmd)
-
-    # fail if a2query cannot be found
-    if cmd_bin is None:
-        error_msg = "Command not found: %s" % cmd
-        module.fail_json(msg=error_msg)
+    cmd_bin = _get_bin_path(module, cmd)
 
+    # Passing an argument list executes the command directly without a shell.
     result, stdout, stderr = module.run_command(
-        "%s %s" % (cmd_bin, params))
+        [cmd_bin] + list(params),
+        use_unsafe_shell=False)
 
     return (result, stdout, stderr)
 
 
-def _get_all_states(module):
+def _load_cache():
+    '''Load the state cache file.
+
+    :returns: dict mapping the item keys to cache entries. Empty if the cache
+      file does not exist or cannot be read.'''
+
+    # the file is plain ASCII JSON. open() has no encoding argument on Python 2.
+    try:
+        with open(STATE_CACHE_FILE) as f: # pylint: disable=unspecified-encoding
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_cache(cache):
+    '''Write the state cache file. Errors are ignored, as the cache is only
+    an optimization.
+
+    :param dict cache: Dictionary mapping the item keys to cache entries.'''
+
+    tmp_file = '%s.%i' % (STATE_CACHE_FILE, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f: # pylint: disable=unspecified-encoding
+            json.dump(cache, f)
+        os.rename(tmp_file, STATE_CACHE_FILE)
+    except (IOError, OSError):
+        pass
+
+
+def _drop_cache_entry(item):
+    '''Remove the cached list of one kind of items, e.g. after changing their
+    states.
+
+    :param str item: The item key.'''
+
+    cache = _load_cache()
+    if item in cache:
+        del cache[item]
+        _save_cache(cache)
+
+
+def _get_cached_names(cache, item, mtime):
+    '''Return the cached list of enabled items of one kind, if it is still
+    valid.
+
+    Modification times can be as coarse as one second, so a change in the same
+    second as the cached query would not be detected. The directory therefore
+    must have been modified before the second in which the entry was written.
+
+    :param dict cache: Dictionary mapping the item keys to cache entries.
+    :param str item: The item key.
+    :param float mtime: Current modification time of the directory with the
+      enabled items.
+    :returns: list of str or None, if there is no valid cache entry.'''
+
+    entry = cache.get(item)
+    if mtime is None or not isinstance(entry, dict):
+        return None
+
+    names = entry.get('names')
+    written = entry.get('written')
+    if not isinstance(names, list) or not isinstance(written, (int, float)):
+        return None
+
+    if entry.get('mtime') != mtime or mtime >= int(written):
+        return None
+
+    return list(names)
+
+
+def _get_enabled_mtime(itemcfg):
+    '''Return the modification time of the directory with the enabled items.
+    It changes whenever an item is enabled or disabled.
+
+    :param ItemCfg itemcfg: Item configuration structure.
+    :returns: float or None, if the directory cannot be accessed.'''
+
+    try:
+        return os.stat(os.path.join(APACHE_CONFDIR, itemcfg.enabled_dir)).st_mtime
+    except OSError:
+        return None
+
+
+def _query_state(module, item):
+    '''Return the list of enabled items of one kind by running a2query. Fail
+    the module if a2query reported an error.
+
+    :param module: Ansible module object.
+    :param str item: The item key.
+    :returns: list of str'''
+
+    names = []
+
+    rc, stdout, stderr = _run_cmd(
+        module,
+        cmd='a2query',
+        params=[SETTINGS[item].query_flag])
+
+    if rc == RC_A2QUERY_NOT_FOUND:
+        # 32 is returned, if no item is enabled (empty list)
+        return names
+
+    if rc != RC_A2QUERY_OK:
+        error_msg = "Error executing a2query: %i %s" % (rc, stderr)
+        module.fail_json(msg=error_msg, rc=rc, stdout=stdout, stderr=stderr)
+
+    # a2query prints one item per line, e.g. 'alias (enabled by ...)'
+    for line in stdout.split('\n'):
+        name, sep, _ = line.partition(' (')
+        if sep and name:
+            names.append(name)
+
+    return names
+
+
+def _get_all_states(module, items, use_cache=False):
     '''Return a dictionary mapping the item keys to lists of enabled items.
 
     :param module: Ansible module object.
+    :param list items: The item keys to query.
+    :param bool use_cache: Use and update the state cache file.
     :returns: dict'''
 
-    # initialize states with empty lists
-    states = {k: [] for k in SETTINGS}
+    cache = _load_cache() if use_cache else {}
+    cache_changed = False
 
-    for item in states:
-        rc, stdout, stderr = _run_cmd(
-            module,
-            cmd='a2query',
-            params='%s' % (SETTINGS[item]['query_flag']))
+    states = {}
+
+    for item in items:
+        # take the time stamp before querying, so that concurrent changes
+        # invalidate the cache entry.
+        mtime = _get_enabled_mtime(SETTINGS[item]) if use_cache else None
 
-        if rc == RC_A2QUERY_NOT_FOUND:
-            # 32 is returned, if no item is enabled (empty list)
+        names = _get_cached_names(cache, item, mtime)
+        if names is not None:
+            states[item] = names
             continue
 
-        if rc != RC_A2QUERY_OK:
-            error_msg = "Error executing a2query: %i %s" % (rc, stderr)
-            module.fail_json(msg=error_msg, rc=rc, stdout=stdout, stderr=stderr)
+        states[item] = _query_state(module, item)
 
-        for line in stdout.split('\n'):
-            m = re.match(r'^(.*) \(.*\)$', line)
-            if m:
-                states[item].append(m.group(1))
+        if mtime is not None:
+            cache[item] = {
+                'mtime': mtime,
+                'written': time.time(),
+                'names': states[item]}
+            cache_changed = True
 
-        states[item].sort()
+    # a dry run must not write to the managed host.
+    if cache_changed and not module.check_mode:
+        _save_cache(cache)
 
     return states
 
 
-def _set_state(module, itemcfg, name, state):
-    '''Set the state (enabled / disabled) of an apache item.
+def _normalize_name(itemcfg, name):
+    '''Return an item name as reported by the tools. They also accept names
+    with a file name suffix like '000-default.conf' and strip it.
+
+    :param ItemCfg itemcfg: Item configuration structure.
+    :param str name: The item name as given by the user.
+    :returns: str'''
+
+    for suffix in itemcfg.name_suffixes:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+
+    return name
+
+
+def _set_state(module, itemcfg, names, state, quiet=True):
+    '''Set the state (enabled / disabled) of apache items.
+
+    All items are passed to one call of the enable or disable tool. If this
+    call fails, the items are processed one by one to find the failing item.
+    The module fails in any case.
 
     :param module: Ansible module object.
-    :param itemcfg: Item configuration structure.
-    :param str name: The item to enable or disable.
-    :param bool state: True to enable, False to disable.'''
+    :param ItemCfg itemcfg: Item configuration structure.
+    :param list names: The items to enable or disable.
+    :param bool state: True to enable, False to disable.
+    :param bool quiet: Suppress the informational output of the tool.
+
+    :returns: Standard output of the tool.'''
 
-    cmd = itemcfg['enable_bin'] if state else itemcfg['disable_bin']
-    param = "-q -f %s" % name
-    (rc, stdout, stderr) = _run_cmd(module, cmd, param)
+    cmd = itemcfg.enable_bin if state else itemcfg.disable_bin
+    params = (['-q'] if quiet else []) + ['-f'] + list(names)
+    (rc, stdout, stderr) = _run_cmd(module, cmd, params)
 
     if rc != RC_A2TOOL_OK:
-        error_msg = "Failed to execute '%s %s'" % (cmd, param)
+        if len(names) > 1:
+            # fails the module for the first failing item
+            for name in names:
+                _set_state(module, itemcfg, [name], state, quiet)
+
+        # report the failed call, also if no single item failed on its own
+        error_msg = "Failed to execute '%s %s'" % (cmd, ' '.join(params))
         module.fail_json(msg=error_msg, rc=rc, stdout=stdout, stderr=stderr)
 
+    return stdout
+
+
+def _get_changes(itemcfg, names, state, enabled):
+    '''Return the items which need to change their state.
+
+    :param ItemCfg itemcfg: Item configuration structure.
+    :param list names: The requested items as given by the user.
+    :param str state: The requested state, i.e. 'present', 'absent' or
+      'exclusive_present'.
+    :param set enabled: The currently enabled items.
+
+    :returns: Tuple of (sorted list of items to enable, sorted list of items to
+      disable)'''
+
+    # use the names as reported by a2query, so that they can be compared and
+    # added to the states.
+    requested = set(_normalize_name(itemcfg, name) for name in names)
+
+    to_enable = []
+    to_disable = []
+    if state == 'present':
+        to_enable = sorted(requested - enabled)
+    elif state == 'absent':
+        to_disable = sorted(requested & enabled)
+    else: # state == 'exclusive_present':
+        to_enable = sorted(requested - enabled)
+        to_disable = sorted(enabled - requested)
+
+    return (to_enable, to_disable)
+
+
+def _exit_assume_state(module, success_msg):
+    '''Exit the module, assuming that all items are already in the requested
+    state.
+
+    :param module: Ansible module object.
+    :param str success_msg: Message to return.'''
+
+    module.exit_json(
+        changed=False,
+        msg=success_msg,
+        warnings=module.warnings)
+
+
+def _exit_skip_check(module, item, success_msg):
+    '''Run the enable or disable tool without querying the states first,
+    detect changes from its output and exit the module.
+
+    :param module: Ansible module object.
+    :param str item: The item key.
+    :param str success_msg: Message to return.'''
+
+    itemcfg = SETTINGS[item]
+
+    if module.params['state'] == 'exclusive_present':
+        module.fail_json(
+            msg="skip_check cannot be used with state exclusive_present")
+
+    any_changed = False
+    if module.params['name']:
+        stdout = _set_state(
+            module,
+            itemcfg,
+            module.params['name'],
+            module.params['state'] == 'present',
+            quiet=False)
+
+        if module.params['cache']:
+            _drop_cache_entry(item)
+
+        requested = set(
+            _normalize_name(itemcfg, name) for name in module.params['name'])
+        unchanged = set(m.group(1) for m in _ALREADY_RE.finditer(stdout))
+        any_changed = bool(requested - unchanged)
+
+    module.exit_json(
+        changed=any_changed,
+        msg=success_msg,
+        warnings=module.warnings)
+
 
 def main():
     '''Module entrypoint.'''
@@ -247,6 +561,9 @@ def main():
                 ITEM_KEY_CONFIG,
                 ITEM_KEY_SITE]),
             state=dict(default='present', choices=['absent', 'present', 'exclusive_present']),
+            assume_state=dict(type='bool', default=False),
+            cache=dict(type='bool', default=True),
+            skip_check=dict(type='bool', default=False),
         ),
         supports_check_mode=True,
     )
@@ -256,44 +573,65 @@ def main():
     item = module.params['item']
     itemcfg = SETTINGS[item]
 
-    states = _get_all_states(module)
-
-
-    # generate a dictionary with all requested state changes
-    req_states = {}
-    if module.params['state'] in ('absent', 'present'):
-        for name in module.params['name']:
-            req_states[name] = (module.params['state'] == 'present')
-    else: # module.params['state'] == 'exclusive_present':
-        # first set all items to 'absent', then overwrite for requested modules.
-        for name in states[item]:
-            req_states[name] = False
-        for name in module.params['name']:
-            req_states[name] = True
-
-
-    # Global change state
-    any_changed = False
-
-    for name, req_state in req_states.items():
-        cur_state = name in states[item]
-
-        changed_state = (cur_state != req_state)
-        any_changed |= changed_state
-
-        # Only run _set_state if not in check mode and a change is requested
-        if not module.check_mode and changed_state:
-            _set_state(module, itemcfg, name, req_state)
-
-    # retrieve all states again after modification.
-    new_states = _get_all_states(module)
+    # resolve all required commands up front, so that the module fails before
+    # any state is queried or changed if one of them is missing.
+    for cmd in ('a2query', itemcfg.enable_bin, itemcfg.disable_bin):
+        _get_bin_path(module, cmd)
 
     success_msg = "%s %s: %s" % (
-        itemcfg['name'],
+        itemcfg.name,
         module.params['state'],
         ', '.join(module.params['name'])
     )
 
+    # in check mode, optionally trust that nothing needs to be changed without
+    # running a2query at all.
+    if module.check_mode and module.params['assume_state']:
+        _exit_assume_state(module, success_msg)
+
+    # optionally run the enable / disable tool right away and detect changes
+    # from its output instead of querying the states with a2query first.
+    if module.params['skip_check'] and not module.check_mode:
+        _exit_skip_check(module, item, success_msg)
+
+    states = _get_all_states(module, [item], module.params['cache'])
+
+    # set of enabled items for fast lookups and set operations
+    enabled = set(states[item])
+
+    to_enable, to_disable = _get_changes(
+        itemcfg, module.params['name'], module.params['state'], enabled)
+
+    any_changed = bool(to_enable or to_disable)
+
+    # Only run _set_state if not in check mode and a change is requested.
+    # Disable first, so that e.g. conflicting modules can be exchanged.
+    if not module.check_mode:
+        if to_disable:
+            _set_state(module, itemcfg, to_disable, False)
+        if to_enable:
+            _set_state(module, itemcfg, to_enable, True)
+
+        if any_changed and module.params['cache']:
+            _drop_cache_entry(item)
+
+    if not any_changed or module.check_mode:
+        # nothing was changed, the states are still valid.
+        new_states = states
+    elif item == ITEM_KEY_MODULE:
+        # a2enmod and a2dismod also act on dependencies of the given modules,
+        # so the result is only known after querying the states again.
+        new_states = _get_all_states(module, [item], module.params['cache'])
+    else:
+        # apply the changes to the known states.
+        new_states = dict(states)
+        new_states[item] = list(
+            enabled.difference(to_disable).union(to_enable))
+
+    # sort the lists only once for the result
+    states = {k: sorted(v) for k, v in states.items()}
+    new_states = {k: sorted(v) for k, v in new_states.items()}
+
     module.exit_json(
         changed=any_changed,
         diff={